@@ -0,0 +1,72 @@
+"""
+FAISS index construction for transcript embeddings.
+
+This module runs inside the index build worker processes, so it must stay free of
+import-time side effects: importing it only loads FAISS and NumPy.
+"""
+import faiss
+import numpy as np
+
+# HNSW graph parameters for the FAISS index.
+# M is the number of neighbours per node; efConstruction and efSearch trade
+# build and query time for recall.
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 100
+HNSW_EF_SEARCH = 64
+
+# Vector compression settings.
+# 8-bit scalar quantization (SQ8) stores one byte per dimension and only needs
+# per-dimension ranges, so it is used from SQ_MIN_TRAINING_VECTORS upwards.
+# Only very short transcripts, where those ranges would be meaningless, keep
+# full-precision vectors.
+# PQ32 stores each vector as 32 one-byte codes, but every index also carries
+# its own codebook of PQ_CENTROIDS float32 vectors (about 786 KB at 768 dims).
+# PQ is only used once its per-vector savings over SQ8 outweigh that codebook,
+# which takes over a thousand chunks.
+PQ_SUBQUANTIZERS = 32
+PQ_CENTROIDS = 256
+SQ_MIN_TRAINING_VECTORS = 16
+
+def build_index(vectors):
+    """
+    Builds an HNSW index over a float32 matrix of embeddings.
+    Vectors are product-quantized or 8-bit scalar-quantized depending on
+    how many there are to train the quantizer on.
+    Vectors are L2-normalized in place so that inner product ranks them by cosine similarity.
+    Each vector is stored under its row number, which is its chunk's position in the document list.
+    """
+    num_vectors, dim = vectors.shape
+    faiss.normalize_L2(vectors)
+    # PQ saves (dim - PQ_SUBQUANTIZERS) bytes per vector over SQ8 but stores a float32 codebook
+    pq_saves_memory = num_vectors * (dim - PQ_SUBQUANTIZERS) > PQ_CENTROIDS * dim * 4
+    # HNSW over PQ codes only supports L2, which ranks unit vectors the same way as inner product
+    metric = faiss.METRIC_INNER_PRODUCT
+    if pq_saves_memory and dim % PQ_SUBQUANTIZERS == 0:
+        storage = f"PQ{PQ_SUBQUANTIZERS}"
+        metric = faiss.METRIC_L2
+    elif num_vectors >= SQ_MIN_TRAINING_VECTORS:
+        storage = "SQ8"
+    else:
+        storage = "Flat"
+    index = faiss.index_factory(dim, f"HNSW{HNSW_M},{storage}", metric)
+    if storage.startswith("PQ"):
+        # A single video never reaches FAISS's recommended 39 points per centroid;
+        # accept that instead of logging a warning for every subquantizer.
+        faiss.downcast_index(index.storage).pq.cp.min_points_per_centroid = 1
+    index.train(vectors)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+    index = faiss.IndexIDMap2(index)
+    index.add_with_ids(vectors, np.arange(num_vectors, dtype="int64"))
+    return index
+
+def build_index_bytes(vectors):
+    """
+    Runs build_index in a worker process.
+    The index is returned serialized because FAISS indexes cannot be pickled.
+    """
+    return faiss.serialize_index(build_index(vectors))
+
+def warm_up_worker():
+    """No-op task used to start a worker process, and import this module in it, ahead of time."""
+
@@ -1,29 +1,81 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from youtube_transcript_api import YouTubeTranscriptApi, TranscriptsDisabled
+from youtube_transcript_api import YouTubeTranscriptApi, TranscriptsDisabled, NoTranscriptFound
 from youtube_transcript_api.proxies import WebshareProxyConfig
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_google_genai import GoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
 from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough, RunnableLambda
+from langchain_core.runnables import Runnable, RunnableParallel, RunnablePassthrough, RunnableLambda
 from langchain_core.output_parsers import StrOutputParser
+import faiss
+import numpy as np
+import asyncio
+import multiprocessing
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from typing import NamedTuple
 from fastapi.middleware.cors import CORSMiddleware
 from cachetools import TTLCache
+import diskcache
+from indexing import build_index_bytes, warm_up_worker
 
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 PROXY_USERNAME = os.getenv("PROXY_USERNAME")
 PROXY_PASSWORD = os.getenv("PROXY_PASSWORD")
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
 
 if not GOOGLE_API_KEY:
     raise EnvironmentError("GOOGLE_API_KEY not found in environment variables.")
 if not PROXY_USERNAME or not PROXY_PASSWORD:
     print("Warning: Proxy credentials not found. Proceeding without proxy.")
 
-app = FastAPI()
+# Process pool for CPU-bound FAISS index builds, so PQ training and HNSW
+# construction do not stall the event loop for other requests.
+# Workers are spawned rather than forked because forking a process that has
+# already started gRPC and OpenMP threads can deadlock the child. They only
+# import the side-effect-free indexing module, not this app.
+INDEX_BUILD_WORKERS = 4
+
+def create_index_build_executor():
+    """Creates the process pool used for index builds."""
+    return ProcessPoolExecutor(max_workers=INDEX_BUILD_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+index_build_executor = create_index_build_executor()
+
+def replace_broken_index_build_executor(broken_executor):
+    """
+    Swaps in a fresh process pool after a worker died (e.g. killed for running out of memory),
+    which leaves the old pool permanently unusable.
+    """
+    global index_build_executor
+    if index_build_executor is broken_executor:
+        index_build_executor = create_index_build_executor()
+    broken_executor.shutdown(wait=False)
+
+async def start_index_build_workers():
+    """Spawns every index build worker up front so no user request pays for process startup."""
+    loop = asyncio.get_running_loop()
+    # The pool starts a new process for each submission while none is idle
+    await asyncio.gather(*(
+        loop.run_in_executor(index_build_executor, warm_up_worker) for _ in range(INDEX_BUILD_WORKERS)
+    ))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background so the server accepts traffic right away
+    warm_up_task = asyncio.create_task(warm_up())
+    yield
+    warm_up_task.cancel()
+    index_build_executor.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -34,57 +86,349 @@ app.add_middleware(
 )
 
 # --- Caching ---
-# In-memory cache for vector stores to improve performance.
-# This cache will store up to 100 vector stores for 1 hour (3600 seconds).
+# In-memory cache for vector indexes and the answer chains built on them.
+# This cache will store up to 100 videos for 1 hour (3600 seconds).
 # This avoids the expensive process of fetching, chunking, and embedding for repeated requests on the same video.
 vectorstore_cache = TTLCache(maxsize=100, ttl=3600)
 
+# Locks for videos that are being loaded or built, keyed by video_id.
+# Concurrent requests for the same uncached video wait for the first one
+# instead of each fetching and embedding the transcript.
+video_build_locks = {}
+
+class VideoBuildLock:
+    """A per-video build lock and the number of requests holding or waiting on it."""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiters = 0
+
+# On-disk cache for serialized FAISS indexes.
+# When a video falls out of the in-memory cache, its index is reloaded from disk
+# instead of re-fetching the transcript and re-embedding every chunk.
+# Entries expire after 24 hours; the least recently used ones are evicted past 1 GB.
+index_cache = diskcache.Cache(CACHE_DIR, size_limit=2**30, eviction_policy="least-recently-used")
+INDEX_CACHE_TTL = 24 * 3600
+
+# Layout of on-disk cache entries. Bump it whenever the stored format changes.
+INDEX_FORMAT_VERSION = 3
+
+# Chunking and embedding settings. These are part of the on-disk cache key,
+# so changing any of them invalidates previously stored indexes.
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+EMBEDDING_MODEL = "models/embedding-001"
+# Number of chunks handed to each concurrent embedding call.
+# The client splits every slice further by its own request-size and token limits.
+EMBEDDING_BATCH_SIZE = 100
+# Maximum number of embedding calls in flight at once per transcript.
+EMBEDDING_CONCURRENCY = 8
+
+# Number of chunks retrieved as context for each question.
+RETRIEVAL_K = 5
+
+class BatchedGoogleGenerativeAIEmbeddings(GoogleGenerativeAIEmbeddings):
+    """
+    Gemini embeddings that embed a transcript's chunks in concurrent slices of
+    EMBEDDING_BATCH_SIZE texts. Each slice goes through the client's own batched
+    embedding call, instead of all slices being awaited one after another.
+    """
+
+    async def aembed_documents(self, texts, titles=None, **kwargs):
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        embed_slice = super().aembed_documents
+
+        async def embed_batch(start):
+            end = start + EMBEDDING_BATCH_SIZE
+            # titles holds one entry per text, so it is sliced with the texts;
+            # the remaining options apply to every slice unchanged
+            batch_kwargs = dict(kwargs) if titles is None else {**kwargs, "titles": titles[start:end]}
+            async with semaphore:
+                return await embed_slice(texts[start:end], **batch_kwargs)
+
+        # gather preserves the order of its arguments, so embeddings line up with texts
+        results = await asyncio.gather(*(embed_batch(start) for start in range(0, len(texts), EMBEDDING_BATCH_SIZE)))
+        return [embedding for batch_embeddings in results for embedding in batch_embeddings]
+
+# --- Models ---
+# Shared clients and prompt, created once at import instead of on every request.
+EMBEDDER = BatchedGoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL, google_api_key=GOOGLE_API_KEY)
+LLM = GoogleGenerativeAI(model="gemini-1.5-flash", google_api_key=GOOGLE_API_KEY, temperature=0.2)
+PARSER = StrOutputParser()
+
+PROMPT = PromptTemplate(
+    template="""
+        You are a helpful assistant designed to answer questions about a YouTube video based on its transcript.
+        Your goal is detailed and accurate answers derived ONLY from the provided context.
+        Do not use any external knowledge.
+        If asked for summary, list all the important topics mentioned in the video as bullet points.
+        If the information to answer the question is not in the context, you must say "I don't have enough information from the transcript to answer that question."
+
+        CONTEXT:
+        {context}
+        
+        QUESTION:
+        {question}
+
+        ANSWER:
+        """,
+    input_variables=["context", "question"]
+)
+
+# Upper bound on startup warm-up, so a slow or retrying Gemini API cannot keep it running indefinitely.
+WARM_UP_TIMEOUT = 30
+
+async def warm_up():
+    """
+    Starts the index build workers and sends a throwaway embedding and 1-token LLM
+    request through each shared client, so the first user request does not pay for
+    process startup, connection setup and credential loading.
+    Gives up after WARM_UP_TIMEOUT seconds. Failures are only logged, since workers
+    and clients also start on demand.
+    """
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                start_index_build_workers(),
+                EMBEDDER.aembed_documents(["warm"]),
+                run_in_threadpool(EMBEDDER.embed_query, "warm"),
+                LLM.ainvoke("hi", max_output_tokens=1),
+            ),
+            timeout=WARM_UP_TIMEOUT,
+        )
+    except Exception as e:
+        print(f"Warning: Startup warm-up did not complete: {e!r}")
+
+# Transcript clients, one per threadpool thread, because YouTubeTranscriptApi is not thread-safe.
+# Each thread reuses its client's HTTP session across requests. Connections are only kept
+# alive without a proxy; the Webshare proxy config asks for them to be closed.
+# Uses proxy configuration if credentials are provided.
+proxy_config = None
+if PROXY_USERNAME and PROXY_PASSWORD:
+    proxy_config = WebshareProxyConfig(
+        proxy_username=PROXY_USERNAME,
+        proxy_password=PROXY_PASSWORD,
+    )
+transcript_clients = threading.local()
+
+def get_transcript_client():
+    """Returns the calling thread's transcript client, creating it on first use."""
+    client = getattr(transcript_clients, "api", None)
+    if client is None:
+        client = transcript_clients.api = YouTubeTranscriptApi(proxy_config=proxy_config)
+    return client
+
+# Transcript languages to accept, in order of preference.
+# A manually created transcript in any of them is preferred over an auto-generated one,
+# since YouTube's speech-recognition captions are usually tagged plain "en".
+TRANSCRIPT_LANGUAGES = ["en", "en-US", "en-GB"]
+
+class MissingTranscript:
+    """
+    Negative cache entry for a video whose transcript is unavailable.
+    Stored in vectorstore_cache so repeated requests fail fast without calling YouTube.
+    """
+
+    def __init__(self, detail: str):
+        self.detail = detail
+
+class CachedVideo(NamedTuple):
+    """
+    In-memory cache entry for a video: its chunk documents, the FAISS index
+    over them, and the precompiled answer chain. Index ids are positions in
+    docs, and keeping the documents lets the index be rebuilt without
+    re-splitting the transcript.
+    """
+    docs: list
+    index: faiss.Index
+    chain: Runnable
+
 class QueryRequest(BaseModel):
     video_id: str
     query: str
 
 
-def format_docs(retrieved_docs):
-    """Helper function to format retrieved documents into a single string."""
-    return "\n\n".join([doc.page_content for doc in retrieved_docs])
-
 def get_transcript(video_id: str):
     """
-    Fetches the transcript for a given YouTube video ID.
-    Uses proxy configuration if credentials are provided.
+    Fetches the transcript for a given YouTube video ID
+    using the calling thread's transcript client.
+    Falls back through TRANSCRIPT_LANGUAGES using a single listing request,
+    taking manually created transcripts before auto-generated ones.
     """
     try:
-        proxy_config = None
-        if PROXY_USERNAME and PROXY_PASSWORD:
-            proxy_config = WebshareProxyConfig(
-                proxy_username=PROXY_USERNAME,
-                proxy_password=PROXY_PASSWORD,
-            )
-        
-        ytt_api = YouTubeTranscriptApi(proxy_config=proxy_config)
-        
-        fetched_transcript = ytt_api.fetch(video_id)
+        # The listing covers every available transcript, so trying fallbacks costs no extra round trips
+        transcripts = get_transcript_client().list(video_id)
+        try:
+            transcript = transcripts.find_manually_created_transcript(TRANSCRIPT_LANGUAGES)
+        except NoTranscriptFound:
+            transcript = transcripts.find_generated_transcript(TRANSCRIPT_LANGUAGES)
+        fetched_transcript = transcript.fetch()
         return "".join(snippet.text for snippet in fetched_transcript)
     except TranscriptsDisabled:
         raise HTTPException(status_code=404, detail="Transcripts are disabled for this video.")
+    except NoTranscriptFound:
+        raise HTTPException(status_code=404, detail="No English transcript is available for this video.")
     except Exception as e:
         # Catching generic exceptions to handle various potential API errors
         raise HTTPException(status_code=500, detail=f"Error fetching transcript: {e}")
 
-def create_vectorstore_from_text(text: str):
+def index_cache_key(video_id: str):
+    """Builds the on-disk cache key for a video's index."""
+    return f"v{INDEX_FORMAT_VERSION}:{video_id}:{EMBEDDING_MODEL}:{CHUNK_SIZE}:{CHUNK_OVERLAP}"
+
+def load_cached_index(video_id: str):
+    """
+    Loads a previously built index and its chunk documents from the on-disk cache.
+    Returns None if the video has not been indexed or the entry cannot be read.
+    Blocks on disk I/O, so call it from a worker thread.
+    """
+    key = index_cache_key(video_id)
+    try:
+        entry = index_cache.get(key)
+        if entry is None:
+            return None
+        index_bytes, texts = entry
+        index = faiss.deserialize_index(index_bytes)
+    except Exception as e:
+        print(f"Warning: Discarding unreadable cached index for {video_id}: {e}")
+        try:
+            index_cache.delete(key)
+        except Exception as e:
+            print(f"Warning: Failed to delete cached index for {video_id}: {e}")
+        return None
+    return index, [Document(page_content=text) for text in texts]
+
+def save_cached_index(video_id: str, index, docs):
+    """
+    Persists an index and the text of its chunk documents to the on-disk cache.
+    Best-effort: failures (e.g. a full or read-only disk) are only logged.
+    Blocks on disk I/O, so call it from a worker thread.
+    """
+    try:
+        entry = (faiss.serialize_index(index), [doc.page_content for doc in docs])
+        index_cache.set(index_cache_key(video_id), entry, expire=INDEX_CACHE_TTL)
+    except Exception as e:
+        print(f"Warning: Failed to persist index for {video_id}: {e}")
+
+def split_text(text: str):
+    """
+    Splits text into fixed-size, overlapping chunks in a single pass.
+    All chunk boundaries are computed at once with NumPy before slicing.
+    A trailing chunk that would fall entirely inside the previous one's overlap is skipped.
+    """
+    starts = np.arange(0, max(len(text) - CHUNK_OVERLAP, 1), CHUNK_SIZE - CHUNK_OVERLAP)
+    ends = np.minimum(starts + CHUNK_SIZE, len(text))
+    return [text[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
+
+def create_documents(text: str):
+    """Splits a transcript into chunk documents."""
+    return [Document(page_content=chunk_text) for chunk_text in split_text(text)]
+
+async def create_index_from_documents(docs):
+    """
+    Creates a FAISS index from already-split chunk documents.
+    1. Generates embeddings for the chunks in concurrent batched requests.
+    2. Indexes the embeddings in an HNSW-backed FAISS index, built in a worker process.
+    """
+    texts = [doc.page_content for doc in docs]
+
+    vectors = np.array(await EMBEDDER.aembed_documents(texts), dtype="float32")
+    loop = asyncio.get_running_loop()
+    executor = index_build_executor
+    try:
+        index_bytes = await loop.run_in_executor(executor, build_index_bytes, vectors)
+    except BrokenProcessPool:
+        replace_broken_index_build_executor(executor)
+        raise HTTPException(status_code=500, detail="Error building index: the worker process stopped unexpectedly.")
+    return faiss.deserialize_index(index_bytes)
+
+def build_context_retriever(index, docs):
     """
-    Creates a FAISS vector store from a given text.
-    1. Splits the text into chunks.
-    2. Generates embeddings for the chunks.
-    3. Indexes the embeddings in a FAISS vector store.
+    Returns a function that turns a query into prompt context in one step:
+    it embeds the query, searches the index and joins the RETRIEVAL_K closest chunks.
+    Search results are index ids, which are looked up directly in the docs list.
     """
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    chunks = splitter.create_documents([text])
+    def retrieve_context(query: str):
+        query_vector = np.array([EMBEDDER.embed_query(query)], dtype="float32")
+        faiss.normalize_L2(query_vector)
+        _, ids = index.search(query_vector, RETRIEVAL_K)
+        # FAISS pads missing results with -1 when there are fewer than k chunks
+        return "\n\n".join(docs[i].page_content for i in ids[0] if i != -1)
+    return retrieve_context
+
+def build_chain(index, docs):
+    """Wires context retrieval over the index into the shared prompt, LLM and parser."""
+    parallel_chain = RunnableParallel({
+        "context": RunnableLambda(build_context_retriever(index, docs)),
+        "question": RunnablePassthrough()
+    })
+    return parallel_chain | PROMPT | LLM | PARSER
 
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001", google_api_key=GOOGLE_API_KEY)
+def lookup_cached_video(video_id: str):
+    """
+    Returns the in-memory cache entry for a video, or None if it is not cached.
+    Raises a 404 if the video is known to have no transcript.
+    """
+    cached = vectorstore_cache.get(video_id)
+    if isinstance(cached, MissingTranscript):
+        raise HTTPException(status_code=404, detail=cached.detail)
+    return cached
+
+async def load_or_build_video(video_id: str):
+    """
+    Loads a video's index from the on-disk cache, or fetches and embeds its
+    transcript if it has not been indexed yet, and adds it to the in-memory cache.
+    """
+    # Fall back to the on-disk cache before fetching and embedding from scratch
+    loaded = await run_in_threadpool(load_cached_index, video_id)
+    if loaded is not None:
+        index, docs = loaded
+    else:
+        try:
+            transcript_text = await run_in_threadpool(get_transcript, video_id)
+            if not transcript_text:
+                raise HTTPException(status_code=404, detail="Could not retrieve transcript content.")
+        except HTTPException as e:
+            # Remember videos without a transcript; other errors may be transient
+            if e.status_code == 404:
+                vectorstore_cache[video_id] = MissingTranscript(e.detail)
+            raise
+        docs = create_documents(transcript_text)
+        index = await create_index_from_documents(docs)
+    cached = CachedVideo(docs, index, build_chain(index, docs))
+    vectorstore_cache[video_id] = cached
+    # Persist newly built indexes only after they are cached in memory
+    if loaded is None:
+        await run_in_threadpool(save_cached_index, video_id, index, docs)
+    return cached
+
+async def get_cached_video(video_id: str):
+    """
+    Returns the cached documents, index and answer chain for a video, building them if needed.
+    Checks the in-memory cache, then the on-disk cache, and only then
+    fetches and embeds the transcript.
+    Concurrent requests for the same uncached video share a single build.
+    """
+    # Check if this video_id (or a known-missing transcript) is already cached
+    cached = lookup_cached_video(video_id)
+    if cached is not None:
+        return cached
 
-    vectorstore = FAISS.from_documents(chunks, embeddings)
-    return vectorstore
+    build_lock = video_build_locks.setdefault(video_id, VideoBuildLock())
+    build_lock.waiters += 1
+    try:
+        async with build_lock.lock:
+            # Another request may have finished building this video while we waited
+            cached = lookup_cached_video(video_id)
+            if cached is not None:
+                return cached
+            return await load_or_build_video(video_id)
+    finally:
+        # Drop the lock only once no request holds or waits on it, so a failed
+        # build is retried by the queued requests one at a time
+        build_lock.waiters -= 1
+        if build_lock.waiters == 0:
+            del video_build_locks[video_id]
 
 # --- API Endpoints ---
 
@@ -94,58 +438,35 @@ def root():
     return {"message": "FastAPI backend for YouTube Chat is running!"}
 
 @app.post("/ask")
-def ask_youtube_bot(request: QueryRequest):
+async def ask_youtube_bot(request: QueryRequest):
     """
     Main endpoint to ask a question about a YouTube video.
     It uses a cache to speed up responses for previously processed videos.
     """
-    video_id = request.video_id
-    query = request.query
-    
-    # Check if a vector store for this video_id already exists in the cache
-    if video_id in vectorstore_cache:
-        vectorstore = vectorstore_cache[video_id]
-    else:
-        # If not in cache, create it and add it to the cache
-        transcript_text = get_transcript(video_id)
-        if not transcript_text:
-            raise HTTPException(status_code=404, detail="Could not retrieve transcript content.")
-        vectorstore = create_vectorstore_from_text(transcript_text)
-        vectorstore_cache[video_id] = vectorstore
-
-    
-    retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 5})
-
-    llm = GoogleGenerativeAI(model="gemini-1.5-flash", google_api_key=GOOGLE_API_KEY, temperature=0.2)
-
-    prompt = PromptTemplate(
-        template="""
-        You are a helpful assistant designed to answer questions about a YouTube video based on its transcript.
-        Your goal is detailed and accurate answers derived ONLY from the provided context.
-        Do not use any external knowledge.
-        If asked for summary, list all the important topics mentioned in the video as bullet points.
-        If the information to answer the question is not in the context, you must say "I don't have enough information from the transcript to answer that question."
-
-        CONTEXT:
-        {context}
-        
-        QUESTION:
-        {question}
-
-        ANSWER:
-        """,
-        input_variables=["context", "question"]
-    )
-
-    parallel_chain = RunnableParallel({
-        "context": retriever | RunnableLambda(format_docs),
-        "question": RunnablePassthrough()
-    })
-    parser = StrOutputParser()
-    main_chain = parallel_chain | prompt | llm | parser
+    video = await get_cached_video(request.video_id)
+    main_chain = video.chain
 
     try:
-        response = main_chain.invoke(query)
+        response = await main_chain.ainvoke(request.query)
         return {"response": response}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating response: {e}")
+
+@app.post("/ask/stream")
+async def ask_youtube_bot_stream(request: QueryRequest):
+    """
+    Same as /ask, but streams the answer as plain text while it is generated.
+    Transcript and indexing errors are still reported as HTTP errors before streaming starts.
+    """
+    video = await get_cached_video(request.video_id)
+    main_chain = video.chain
+
+    async def generate():
+        try:
+            async for chunk in main_chain.astream(request.query):
+                yield chunk
+        except Exception as e:
+            # The status code has already been sent, so report the error in the body
+            yield f"\n\nError generating response: {e}"
+
+    return StreamingResponse(generate(), media_type="text/plain")